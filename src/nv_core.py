@@ -0,0 +1,539 @@
+"""Shared NV center detection, visualization and batch processing for FSM scans"""
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import json
+from scipy import ndimage
+import os
+import warnings
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from itertools import repeat
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bins for the intensity histogram computed alongside detection
+HIST_BINS = 50
+
+# A light_viz figure renders in under a second, about what starting a worker
+# process costs, so smaller light_viz batches are saved serially
+LIGHT_VIZ_MIN_PARALLEL = 4
+
+# Gaussian smoothing applied before peak detection
+GAUSSIAN_SIGMA = 1
+GAUSSIAN_TRUNCATE = 4.0
+
+def _gaussian_kernel1d(sigma, truncate=GAUSSIAN_TRUNCATE):
+    """Build a normalized 1D Gaussian kernel"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+# Built once at import so it isn't re-derived for every scan
+_GAUSSIAN_KERNEL = _gaussian_kernel1d(GAUSSIAN_SIGMA)
+
+# Two 3-wide box passes, written as the single kernel they amount to per axis
+_BOX_KERNEL = np.array([1, 2, 3, 2, 1]) / 9
+
+def _separable_blur(image, kernel1d):
+    """Blur an image with two 1D passes (rows, then columns) of the same kernel"""
+    # Smooth into float64 so near-equal peaks don't round into ties
+    smoothed = ndimage.correlate1d(image, kernel1d, axis=0, output=np.float64, mode='reflect')
+    return ndimage.correlate1d(smoothed, kernel1d, axis=1, mode='reflect')
+
+@lru_cache(maxsize=None)
+def _pixel_indices(n):
+    """Pixel index abscissae for mapping peaks onto scan positions, cached per axis length"""
+    indices = np.arange(n)
+    indices.flags.writeable = False
+    return indices
+
+def _index_to_position(indices, steps):
+    """Map pixel indices onto scan positions along one axis"""
+    # FSM scans sample each axis uniformly, so the mapping is affine and needs no search
+    if len(steps) > 1:
+        step = steps[1] - steps[0]
+        if np.allclose(np.diff(steps), step):
+            return steps[0] + indices * step
+    return np.interp(indices, _pixel_indices(len(steps)), steps)
+
+@lru_cache(maxsize=None)
+def _numba_kernel():
+    """The Numba detection kernel, imported once per process on first use (None without numba)"""
+    try:
+        from nv_numba import detect_kernel
+    except ImportError:
+        warnings.warn("use_numba=True but numba is not installed; using the NumPy path")
+        return None
+    return detect_kernel
+
+def _ensure_spacing(coordinates, values, min_distance):
+    """Drop peaks closer than min_distance (Chebyshev) to a kept brighter-or-equal one, as peak_local_max does"""
+    # Peaks inside each other's window must tie, so only runs of equal values need checking
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    keep = np.ones(len(coordinates), dtype=bool)
+    for start, end in zip(starts, ends):
+        for i in range(start, end - 1):
+            if keep[i]:
+                distance = np.abs(coordinates[i + 1:end] - coordinates[i]).max(axis=1)
+                keep[i + 1:end] &= distance >= min_distance
+    return coordinates[keep]
+
+def _local_maxima(smoothed, above, min_distance):
+    """Coordinates of pixels above threshold that are the maximum of their window, brightest first"""
+    if min_distance < 1:
+        # A 1x1 window makes every pixel its own maximum: no filter, plateau check or border
+        coordinates = np.argwhere(above)
+        return coordinates[np.argsort(-smoothed[above], kind='stable')]
+    window_max = ndimage.maximum_filter(smoothed, size=2 * min_distance + 1, mode='nearest')
+    is_peak = smoothed == window_max
+    # A constant image has no peaks
+    if is_peak.all():
+        return np.array([]).reshape(0, 2)
+    is_peak &= above
+    # Skip a min_distance-wide border, as peak_local_max does by default
+    is_peak[:min_distance] = False
+    is_peak[-min_distance:] = False
+    is_peak[:, :min_distance] = False
+    is_peak[:, -min_distance:] = False
+    coordinates = np.argwhere(is_peak)
+    order = np.argsort(-smoothed[is_peak], kind='stable')
+    coordinates = coordinates[order]
+    if min_distance > 1:
+        # A flat top is a maximum at every pixel; keep one per min_distance
+        coordinates = _ensure_spacing(coordinates, smoothed[is_peak][order], min_distance)
+    return coordinates
+
+def loadJson(filename):
+    """Load a JSON file and return the data dictionary"""
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN/Infinity literals json writes for unfinished scans
+            pass
+    with open(filename) as f:
+        dataDict = json.load(f)
+    return dataDict
+
+def detect_nv_centers(data, threshold_factor=2.0, min_distance=5, min_peak_height=None, kernel1d=None,
+                      blur='gauss', use_numba=False):
+    """Detect NV centers in FSM scan data
+
+    kernel1d is the 1D smoothing kernel; pass one built by _gaussian_kernel1d
+    to reuse it across many scans (defaults to the module-level kernel).
+    blur='box' instead smooths with two 3x3 box filters, which is cheaper but
+    broader and finds fewer, occasionally shifted, peaks; kernel1d is then
+    ignored. use_numba=True runs the blur and peak search in the optional
+    Numba kernel (nv_numba), which rounds exactly like the NumPy path and
+    so gives the same smoothed scan and peaks; it only pays off once its
+    JIT cache is warm.
+    The results include the scan as a float32 array ('scan_counts') and the
+    boolean threshold mask of the smoothed scan ('mask'), so plotting
+    doesn't need to recompute either.
+    """
+    if blur == 'box':
+        kernel1d = _BOX_KERNEL
+    elif blur != 'gauss':
+        raise ValueError(f"blur must be 'gauss' or 'box', got {blur!r}")
+    elif kernel1d is None:
+        kernel1d = _GAUSSIAN_KERNEL
+
+    # Extract scan data; photon counts fit float32 exactly, halving the bytes the filters stream
+    scan_counts = np.asarray(data['datasets']['ScanCounts'], dtype=np.float32)
+    x_steps = np.array(data['datasets']['xSteps'])
+    y_steps = np.array(data['datasets']['ySteps'])
+    
+    # Check if data is not empty or all NaN
+    nan_mask = np.isnan(scan_counts)
+    if scan_counts.size == 0 or nan_mask.all():
+        # Return empty results with valid structure
+        hist, bin_edges = np.histogram(np.array([]), bins=HIST_BINS)
+        return {
+            'coordinates': np.array([]).reshape(0, 2),
+            'x_positions': np.array([]),
+            'y_positions': np.array([]),
+            'intensities': np.array([]),
+            'scan_counts': scan_counts,
+            'processed_image': scan_counts,
+            'mask': np.zeros(scan_counts.shape, dtype=bool),
+            'threshold': 0,
+            'histogram': hist,
+            'bin_edges': bin_edges
+        }
+    
+    # Mean and std from the sum and sum of squares of the valid pixels, rather than
+    # separate nanmean/nanstd sweeps over the whole scan (accumulated in float64,
+    # since the sum of squares cancels badly in float32)
+    has_nan = nan_mask.any()
+    valid = scan_counts[~nan_mask] if has_nan else scan_counts.ravel()
+    with np.errstate(invalid='ignore'):
+        mean_count = valid.sum(dtype=np.float64) / valid.size
+        sq_total = np.einsum('i,i->', valid, valid, dtype=np.float64)
+        std_count = np.sqrt(max(sq_total / valid.size - mean_count ** 2, 0.0))
+    
+    # Fallback if mean or std are NaN
+    if np.isnan(mean_count) or np.isnan(std_count):
+        mean_count = 0
+        std_count = 0
+    
+    if min_peak_height is None:
+        threshold = mean_count + threshold_factor * std_count
+    else:
+        threshold = min_peak_height
+    
+    detect_kernel = _numba_kernel() if use_numba else None
+    # The Numba kernel sums like correlate1d only for odd, symmetric kernels (both
+    # blurs' are); NaN-containing scans and other kernels take the NumPy path
+    if (detect_kernel is not None and scan_counts.ndim == 2 and not has_nan
+            and len(kernel1d) % 2 == 1 and np.array_equal(kernel1d, kernel1d[::-1])):
+        smoothed, coordinates = detect_kernel(scan_counts, np.asarray(kernel1d, dtype=np.float64),
+                                              float(threshold), max(int(min_distance), 0))
+        above = smoothed > threshold
+    else:
+        # Apply blur to reduce noise (separable: 2(2r+1) taps per pixel instead of (2r+1)^2)
+        smoothed = _separable_blur(scan_counts, kernel1d)
+        
+        # Find local peaks (with checks for empty data)
+        above = smoothed > threshold
+        if threshold <= 0 or not above.any():
+            # No peaks found
+            coordinates = np.array([]).reshape(0, 2)
+        else:
+            coordinates = _local_maxima(smoothed, above, min_distance)
+    
+    # Intensity histogram of the valid pixels, computed once here for plotting
+    hist, bin_edges = np.histogram(valid, bins=HIST_BINS)
+    
+    # Handle empty coordinates case
+    if len(coordinates) == 0:
+        return {
+            'coordinates': np.array([]).reshape(0, 2),
+            'x_positions': np.array([]),
+            'y_positions': np.array([]),
+            'intensities': np.array([]),
+            'scan_counts': scan_counts,
+            'processed_image': smoothed,
+            'mask': above,
+            'threshold': threshold,
+            'histogram': hist,
+            'bin_edges': bin_edges
+        }
+    
+    # Map coordinates to actual positions
+    y_indices = coordinates[:, 0]
+    x_indices = coordinates[:, 1]
+    
+    # Reverse the y-axis to match the plot's orientation
+    y_positions = _index_to_position(y_indices, y_steps[::-1])  # Reverse y_steps
+    x_positions = _index_to_position(x_indices, x_steps)
+    
+    # Get intensity values at the peaks
+    intensities = scan_counts[y_indices, x_indices]
+    
+    return {
+        'coordinates': coordinates,
+        'x_positions': x_positions,
+        'y_positions': y_positions,
+        'intensities': intensities,
+        'scan_counts': scan_counts,
+        'processed_image': smoothed,
+        'mask': above,
+        'threshold': threshold,
+        'histogram': hist,
+        'bin_edges': bin_edges
+    }
+
+class Visualizer:
+    """Six-panel figure of the detection results, reused across scans
+
+    The figure, its axes and colorbars are built once. The four image
+    panels keep their AxesImage and later scans swap their data in with
+    set_data; only the 3D surface and histogram are redrawn. Constrained
+    layout re-fits the panels to each scan's labels when the figure is
+    rendered. Without fig, an off-screen Figure on an Agg canvas is
+    created; a figure passed in should use layout='constrained'. light_viz
+    draws a coarser, non-antialiased 3D surface and saves at 100 dpi
+    instead of 300.
+    """
+    
+    def __init__(self, fig=None, light_viz=False):
+        if fig is None:
+            fig = Figure(figsize=(15, 10), layout='constrained')
+            FigureCanvasAgg(fig)
+        self.fig = fig
+        self.light_viz = light_viz
+        self.axes = [
+            fig.add_subplot(231),
+            fig.add_subplot(232),
+            fig.add_subplot(233),
+            fig.add_subplot(234),
+            fig.add_subplot(235, projection='3d'),
+            fig.add_subplot(236),
+        ]
+        self._images = None
+        self._markers = None
+        self._positions = None
+    
+    def draw(self, data, results):
+        """Plot one scan's results onto the figure"""
+        # The scan array detect_nv_centers already built, rather than re-parsing data
+        scan_counts = results['scan_counts']
+        x_steps = np.array(data['datasets']['xSteps'])
+        y_steps = np.array(data['datasets']['ySteps'])
+        threshold = results['threshold']
+        smoothed = results['processed_image']
+        mask = results['mask']
+        # One vectorized min/max per axis, shared by all image panels
+        extent = [x_steps.min(), x_steps.max(), y_steps.min(), y_steps.max()]
+        ax1, ax2, ax3, ax4, ax5, ax6 = self.axes
+        image_axes = (ax1, ax2, ax3, ax4)
+        panels = (scan_counts, smoothed, mask, scan_counts)
+        
+        if self._images is None:
+            # Original scan, smoothed scan, threshold mask and detected NV centers
+            self._images = [
+                ax1.imshow(scan_counts, cmap='hot', extent=extent),
+                ax2.imshow(smoothed, cmap='hot', extent=extent),
+                ax3.imshow(mask, cmap='gray', extent=extent),
+                ax4.imshow(scan_counts, cmap='hot', extent=extent),
+            ]
+            self.fig.colorbar(self._images[0], ax=ax1, label='Counts/s')
+            self.fig.colorbar(self._images[1], ax=ax2, label='Counts/s (smoothed)')
+            self.fig.colorbar(self._images[3], ax=ax4, label='Counts/s')
+            ax1.set_title('Original FSM Scan')
+            ax2.set_title('Smoothed Scan')
+            for ax in image_axes:
+                ax.set_xlabel('X Position (μm)')
+                ax.set_ylabel('Y Position (μm)')
+            self._positions = [(ax, ax.get_position(original=True)) for ax in self.fig.axes if ax is not ax5]
+        else:
+            # Constrained layout starts from the current positions, so put the
+            # panels back where a fresh figure has them before laying out again
+            for ax, position in self._positions:
+                ax.set_position(position)
+                ax.set_in_layout(True)
+            for ax, im, image in zip(image_axes, self._images, panels):
+                im.set_data(image)
+                # Rescale colours (and the colorbars) to the new data, as imshow would
+                im.autoscale()
+                im.set_extent(extent)
+                # Pin the limits so the markers don't autoscale against earlier scans
+                ax.set_xlim(extent[0], extent[1])
+                ax.set_ylim(extent[2], extent[3])
+        
+        ax3.set_title(f'Threshold Mask (>{threshold:.1f} counts/s)')
+        ax4.set_title(f'Detected NV Centers: {len(results["coordinates"])}')
+        
+        # Plot markers at NV centers
+        if self._markers is not None:
+            self._markers.remove()
+            self._markers = None
+        if len(results["coordinates"]) > 0:
+            self._markers = ax4.scatter(results['x_positions'], results['y_positions'], 
+                                        s=50, facecolors='none', edgecolors='red')
+        
+        # Plot 3D surface of the scan. Replaced rather than cleared: a cleared
+        # 3D axes keeps the previous scan's z tick labels until it is drawn,
+        # and constrained layout sizes the panel from those stale labels
+        ax5.remove()
+        ax5 = self.axes[4] = self.fig.add_subplot(235, projection='3d')
+        X, Y = np.meshgrid(x_steps, y_steps, sparse=True)
+        if self.light_viz:
+            ax5.plot_surface(X, Y, scan_counts, cmap='hot', linewidth=0, antialiased=False,
+                             rstride=8, cstride=8)
+        else:
+            ax5.plot_surface(X, Y, scan_counts, cmap='hot', linewidth=0, antialiased=True)
+        ax5.set_title('3D Surface Plot')
+        ax5.set_xlabel('X Position (μm)')
+        ax5.set_ylabel('Y Position (μm)')
+        ax5.set_zlabel('Counts/s')
+        
+        # Plot intensity histogram with threshold
+        ax6.clear()
+        bin_edges = results['bin_edges']
+        ax6.bar(0.5 * (bin_edges[:-1] + bin_edges[1:]), results['histogram'],
+                width=np.diff(bin_edges), alpha=0.7, color='blue')
+        ax6.axvline(x=threshold, color='red', linestyle='--', 
+                   label=f'Threshold: {threshold:.1f}')
+        ax6.set_title('Intensity Histogram')
+        ax6.set_xlabel('Counts/s')
+        ax6.set_ylabel('Frequency')
+        ax6.legend()
+    
+    def visualize(self, data, results, output_path):
+        """Plot one scan's results and save the figure to output_path"""
+        self.draw(data, results)
+        self.fig.savefig(output_path, dpi=100 if self.light_viz else 300)
+
+def visualize_results(data, results, output_path=None, light_viz=False):
+    """Visualize the detection results
+
+    Saves to output_path if given, otherwise shows the figure with pyplot.
+    For many scans, reuse a single Visualizer instead.
+    """
+    if output_path:
+        Visualizer(light_viz=light_viz).visualize(data, results, output_path)
+    else:
+        Visualizer(plt.figure(figsize=(15, 10), layout='constrained'), light_viz=light_viz).draw(data, results)
+        plt.show()
+
+# One Visualizer per process, reused for every figure that process saves
+_visualizer = None
+
+def _init_visualizer(light_viz):
+    """Create this process's shared Visualizer (also the worker initializer)"""
+    global _visualizer
+    _visualizer = Visualizer(light_viz=light_viz)
+
+def _process_one(file_path, output_dir, kwargs, visualize=True):
+    """Process a single FSM JSON file
+
+    Runs in a worker process during batch runs, so progress lines are
+    collected and returned with the results (None on failure) rather than
+    printed here. With visualize=False no figure is drawn or shown.
+    """
+    log = []
+    try:
+        # Load data
+        data = loadJson(file_path)
+        
+        # Extract basic info
+        params = data['params']
+        log.append(f"  Scan center: {params.get('CenterOfScan', 'N/A')}")
+        log.append(f"  Sweep ranges: {params.get('sweepRanges', 'N/A')} μm")
+        log.append(f"  Resolution: {params.get('scanPointsPerAxis', 'N/A')} points")
+        
+        # Detect NV centers
+        results = detect_nv_centers(data, **kwargs)
+        
+        log.append(f"  Detected {len(results['coordinates'])} potential NV centers")
+        
+        # Visualize and save results if output directory is provided
+        if output_dir:
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            # Save PNG
+            if visualize:
+                _visualizer.visualize(
+                    data, results,
+                    os.path.join(output_dir, f"{base_name}_results.png")
+                )
+            # Prepare results for JSON serialization
+            json_results = {
+                'file': os.path.basename(file_path),
+                'params': data.get('params', {}),
+                'coordinates': results['coordinates'].tolist() if results['coordinates'] is not None else [],
+                'x_positions': results['x_positions'].tolist() if results['x_positions'] is not None else [],
+                'y_positions': results['y_positions'].tolist() if results['y_positions'] is not None else [],
+                'intensities': results['intensities'].tolist() if results['intensities'] is not None else [],
+                'threshold': results.get('threshold', None),
+                # Optionally, you can add more fields as needed
+            }
+            # Save JSON
+            json_path = os.path.join(output_dir, f"{base_name}_results.json")
+            with open(json_path, 'w') as jf:
+                json.dump(json_results, jf, indent=2)
+        elif visualize:
+            visualize_results(data, results)
+        
+    except Exception as e:
+        log.append(f"  Error processing file: {e}")
+        results = None
+    
+    return results, log
+
+def process_fsm_files(file_paths, output_dir=None, sigma=GAUSSIAN_SIGMA, max_workers=None,
+                      light_viz=False, visualize=True, **kwargs):
+    """Process multiple FSM JSON files
+
+    Batches that save figures are rendered in parallel across max_workers
+    processes (default: one per CPU), each drawing with its own Visualizer.
+    Workers are spawned, not forked, so scripts calling this must guard
+    their entry point with if __name__ == "__main__". light_viz makes
+    figures quicker to render; light_viz batches of fewer than
+    LIGHT_VIZ_MIN_PARALLEL files are rendered serially, as are runs with a
+    single worker. Interactive figures (visualize without output_dir) are
+    shown one file at a time, and visualize=False, which skips all plotting
+    and only computes (and, with output_dir, saves) the numeric results,
+    also runs serially, since that is quicker than starting workers. If a
+    worker dies, its unfinished files are reported as errors and the
+    results already computed are still returned.
+
+    sigma sets the Gaussian blur's width and so only applies to the default
+    blur='gauss'; combining a non-default sigma with blur='box' raises
+    ValueError.
+    """
+    global _visualizer
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    if kwargs.get('blur') == 'box' and sigma != GAUSSIAN_SIGMA:
+        raise ValueError(f"sigma={sigma!r} only applies to blur='gauss'; blur='box' has a fixed kernel")
+    
+    # Build the smoothing kernel once for the whole batch
+    kwargs.setdefault('kernel1d', _gaussian_kernel1d(sigma))
+    
+    # Suppress the specific NumPy warnings globally
+    warnings.filterwarnings('ignore', message='Mean of empty slice')
+    warnings.filterwarnings('ignore', message='invalid value encountered in scalar divide')
+    warnings.filterwarnings('ignore', message='invalid value encountered in true_divide')
+    
+    all_results = []
+    
+    save_figures = visualize and bool(output_dir)
+    
+    # Only rendering is slow enough to repay starting worker processes; detection
+    # alone takes milliseconds per scan
+    workers = min(max_workers or os.cpu_count() or 1, len(file_paths))
+    parallel = save_figures and workers > 1
+    if light_viz and len(file_paths) < LIGHT_VIZ_MIN_PARALLEL:
+        parallel = False
+    if parallel:
+        # Spawn fresh workers: forking a parent that already runs threaded
+        # libraries (JIT runtimes, BLAS, GUI toolkits) can deadlock it
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_visualizer, initargs=(light_viz,))
+        outcomes = executor.map(_process_one, file_paths, repeat(output_dir), repeat(kwargs),
+                                repeat(visualize))
+    else:
+        executor = None
+        if save_figures:
+            _init_visualizer(light_viz)
+        outcomes = map(_process_one, file_paths, repeat(output_dir), repeat(kwargs),
+                       repeat(visualize))
+    
+    try:
+        # Both maps yield in input order, so the log reads the same either way
+        broken = None
+        for idx, file_path in enumerate(file_paths):
+            print(f"Processing file {idx+1}/{len(file_paths)}: {os.path.basename(file_path)}")
+            if broken is None:
+                try:
+                    results, log = next(outcomes)
+                except BrokenProcessPool as e:
+                    # A worker died: keep what's done and report every file left
+                    broken = e
+            if broken is not None:
+                results, log = None, [f"  Error processing file: {broken}"]
+            for line in log:
+                print(line)
+            if results is not None:
+                all_results.append(results)
+            print("-" * 50)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _visualizer = None
+    
+    return all_results
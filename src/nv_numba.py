@@ -0,0 +1,112 @@
+"""Optional Numba kernel for detect_nv_centers(use_numba=True)
+
+Imported by nv_core only when asked for, so plain runs never load numba.
+"""
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def reflect_index(i, n):
+    """Mirror an out-of-range index back into [0, n), as ndimage's 'reflect' mode does"""
+    period = 2 * n
+    i = i % period
+    if i >= n:
+        i = period - i - 1
+    return i
+
+# No fast-math: the blur has to round exactly as ndimage.correlate1d does, or
+# near-tied pixels compare differently from the NumPy path
+@njit(cache=True)
+def detect_kernel(counts, kernel1d, threshold, min_distance):
+    """Fused separable blur and local-maximum search over one NaN-free scan
+
+    Mirrors the NumPy path ('reflect' smoothing, window maxima with a
+    min_distance border skipped, one peak per min_distance on flat tops).
+    kernel1d must be odd-length and symmetric: each output is then summed
+    in correlate1d's order (centre tap, then mirrored pairs from the
+    outside in), so smoothed and the peaks match the NumPy path exactly.
+    Returns (smoothed, coordinates).
+    """
+    ny, nx = counts.shape
+    no_peaks = np.empty((0, 2), dtype=np.int64)
+    
+    # Separable blur: columns into a scratch buffer, then rows. The column pass
+    # walks contiguous rows so its inner loop vectorizes; edges are reflected once per row.
+    r = len(kernel1d) // 2
+    scratch = np.empty((ny, nx))
+    for i in range(ny):
+        acc = np.empty(nx)
+        for j in range(nx):
+            acc[j] = np.float64(counts[i, j]) * kernel1d[r]
+        for k in range(r, 0, -1):
+            w = kernel1d[r - k]
+            lo = reflect_index(i - k, ny)
+            hi = reflect_index(i + k, ny)
+            for j in range(nx):
+                acc[j] += (np.float64(counts[lo, j]) + np.float64(counts[hi, j])) * w
+        for j in range(nx):
+            scratch[i, j] = acc[j]
+    smoothed = np.empty((ny, nx))
+    for i in range(ny):
+        padded = np.empty(nx + 2 * r)
+        for j in range(nx + 2 * r):
+            padded[j] = scratch[i, reflect_index(j - r, nx)]
+        for j in range(nx):
+            acc = padded[j + r] * kernel1d[r]
+            for k in range(r, 0, -1):
+                acc += (padded[j + r - k] + padded[j + r + k]) * kernel1d[r - k]
+            smoothed[i, j] = acc
+    
+    # A constant image has no peaks (every pixel ties with its neighbourhood),
+    # unless the window is a single pixel
+    if threshold <= 0 or (min_distance > 0 and smoothed.min() == smoothed.max()):
+        return smoothed, no_peaks
+    
+    # Window maxima over a (2*min_distance+1)^2 neighbourhood, skipping a
+    # min_distance-wide border like the NumPy path
+    is_peak = np.zeros((ny, nx), dtype=np.bool_)
+    for i in range(min_distance, ny - min_distance):
+        for j in range(min_distance, nx - min_distance):
+            v = smoothed[i, j]
+            if not v > threshold:
+                continue
+            peak = True
+            for wi in range(max(i - min_distance, 0), min(i + min_distance + 1, ny)):
+                for wj in range(max(j - min_distance, 0), min(j + min_distance + 1, nx)):
+                    if smoothed[wi, wj] > v:
+                        peak = False
+                        break
+                if not peak:
+                    break
+            is_peak[i, j] = peak
+    
+    # Highest peak first
+    ys, xs = np.nonzero(is_peak)
+    values = np.empty(len(ys))
+    for p in range(len(ys)):
+        values[p] = smoothed[ys[p], xs[p]]
+    order = np.argsort(-values, kind='mergesort')
+    
+    # A flat top is a maximum at every pixel: keep a peak only if no kept
+    # brighter-or-equal peak lies within min_distance (Chebyshev), as
+    # peak_local_max does. Peaks inside each other's window must tie, so the
+    # scan stops at the first lower value.
+    keep = np.ones(len(order), dtype=np.bool_)
+    if min_distance > 1:
+        for a in range(len(order)):
+            if not keep[a]:
+                continue
+            for b in range(a + 1, len(order)):
+                if values[order[b]] != values[order[a]]:
+                    break
+                if (abs(ys[order[b]] - ys[order[a]]) < min_distance
+                        and abs(xs[order[b]] - xs[order[a]]) < min_distance):
+                    keep[b] = False
+    coordinates = np.empty((keep.sum(), 2), dtype=np.int64)
+    c = 0
+    for a in range(len(order)):
+        if keep[a]:
+            coordinates[c, 0] = ys[order[a]]
+            coordinates[c, 1] = xs[order[a]]
+            c += 1
+    return smoothed, coordinates